@@ -1,11 +1,23 @@
 import os
 import shutil
+import logging
 import tempfile
-import glob
+import atexit
+import threading
+import contextlib
+import copy
+import time
+import random
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 from app.log_config import setup_logger
 import functools
 
 import yt_dlp
+from yt_dlp.cookies import YoutubeDLCookieJar
+from yt_dlp.extractor import gen_extractor_classes
+from yt_dlp.postprocessor import get_postprocessor
+from yt_dlp.networking.exceptions import HTTPError, TransportError
 from yt_dlp.utils import DownloadError, ExtractorError
 
 # ---------- Logger ----------
@@ -13,70 +25,78 @@ logger = setup_logger("downloader")
 logger.info("Logger for downloader initialized")
 
 # ---------- Cookie handling ----------
-_cookie_file_path = None
+_UNSET = object()
+_cookie_env_path = _UNSET
+_cookie_lock = threading.Lock()
 
 
 def _get_cookie_file():
     """
-    Read COOKIE_PATH env.
-    If file exists but is read-only (e.g. /etc/secrets),
-    copy to a writable temp file and reuse it.
+    Read COOKIE_PATH env (once per process).
+    The file is only read (into the shared jar, never saved back),
+    so a read-only location (e.g. /etc/secrets) is used as-is.
     """
-    global _cookie_file_path
+    global _cookie_env_path
 
-    path = os.environ.get("COOKIE_PATH")
-    logger.info("COOKIE_PATH env = %s", path)
+    with _cookie_lock:
+        if _cookie_env_path is _UNSET:
+            _cookie_env_path = os.environ.get("COOKIE_PATH")
+            logger.info("COOKIE_PATH env = %s", _cookie_env_path)
 
+    path = _cookie_env_path
     if not path:
-        logger.info("COOKIE_PATH not set")
         return None
 
     if not os.path.isfile(path):
         logger.info("Cookie file NOT found at: %s", path)
         return None
 
-    if _cookie_file_path:
-        logger.info("Reusing temp cookie file: %s", _cookie_file_path)
-        return _cookie_file_path
+    return path
 
-    try:
-        tmp = tempfile.NamedTemporaryFile(
-            delete=False,
-            mode="w",
-            encoding="utf-8",
-            suffix=".txt",
-        )
-        tmp.close()
 
-        shutil.copyfile(path, tmp.name)
-        _cookie_file_path = tmp.name
+_cookie_jar = None
+_cookie_jar_lock = threading.Lock()
 
-        logger.info(
-            "Cookie file copied from %s (read-only) → %s (writable)",
-            path,
-            _cookie_file_path,
-        )
-        return _cookie_file_path
 
-    except Exception as e:
-        logger.info("Failed to prepare temp cookie file: %s", e)
+def _get_cookie_jar():
+    """
+    Cookie jar parsed once from the cookie file and shared by every
+    YoutubeDL instance (CookieJar is internally locked).
+    """
+    global _cookie_jar
+
+    if _cookie_jar is not None:
+        return _cookie_jar
+
+    cookie_file = _get_cookie_file()
+    if not cookie_file:
         return None
 
+    with _cookie_jar_lock:
+        if _cookie_jar is None:
+            jar = YoutubeDLCookieJar(cookie_file)
+            jar.load(ignore_discard=True, ignore_expires=True)
+            _cookie_jar = jar
+            logger.info("Cookie jar loaded: %d cookies", len(jar))
+
+    return _cookie_jar
+
 
 # ---------- Deno (JS runtime) ----------
+@functools.lru_cache(maxsize=1)
 def _enable_deno() -> bool:
     """
     Enable Deno JS runtime if:
     - ENV DENO is truthy
     - deno binary exists in PATH
+    Env and PATH are process-constant, so the answer is cached.
     """
     env_flag = os.environ.get("ENABLE_DENO", "").lower()
     if env_flag not in ("1", "true", "yes", "on"):
         logger.info("DENO env disabled or not set")
         return False
 
-    from shutil import which
-    if which("deno") is None:
+    if shutil.which("deno") is None:
         logger.info("DENO env enabled but deno binary not found")
         return False
 
@@ -84,9 +104,90 @@ def _enable_deno() -> bool:
     return True
 
 
+# ---------- aria2c (external downloader) ----------
+_aria2c_path = shutil.which("aria2c")
+
+
+def _aria2c_opts(args: list[str]) -> dict:
+    """
+    yt-dlp options to hand HTTP downloads to aria2c (multi-connection).
+    Empty when aria2c is not installed.
+    """
+    if not _aria2c_path:
+        return {}
+
+    return {
+        "external_downloader": "aria2c",
+        "external_downloader_args": {"aria2c": args},
+    }
+
+
+# ---------- Progress emitter ----------
+# Latest pending progress payload per key; one background task emits them,
+# so a slow socket never stalls the download thread. Newer payloads replace
+# unsent ones (drop-oldest).
+_pending_progress: dict = {}
+_pending_lock = threading.Lock()
+_pending_event = threading.Event()
+# held while a taken batch is being emitted (see _drop_progress)
+_emit_lock = threading.Lock()
+_emitter_started = False
+
+
+def _emit_loop():
+    while True:
+        _pending_event.wait()
+        _pending_event.clear()
+
+        with _emit_lock:
+            with _pending_lock:
+                batch = list(_pending_progress.values())
+                _pending_progress.clear()
+
+            for socket, payload in batch:
+                try:
+                    socket.emit("download_status", payload, to=payload["key"])
+                except Exception as e:
+                    logger.warning("progress emit error: %s", e)
+
+
+def _queue_progress(socket, key, payload: dict):
+    global _emitter_started
+
+    with _pending_lock:
+        _pending_progress[key] = (socket, payload)
+        start = not _emitter_started
+        _emitter_started = True
+    if start:
+        # same async mode as the app (a greenlet under eventlet)
+        socket.start_background_task(_emit_loop)
+    _pending_event.set()
+
+
+def _drop_progress(key):
+    """
+    Discard key's unsent progress before a terminal emit. Also waits out a
+    batch already taken by _emit_loop, so no stale "downloading" payload
+    can reach the room after the caller's terminal state.
+    """
+    with _pending_lock:
+        _pending_progress.pop(key, None)
+    with _emit_lock:
+        pass
+
+
 # ---------- yt-dlp utils ----------
 # Global dict để lưu percent trước đó
 _last_percent = {}
+# monotonic time of the last socket emit per key
+_last_emit = {}
+_EMIT_INTERVAL = 0.25  # max 4 progress emits / second / key
+
+
+def _forget_hook_state(key):
+    # download_video's exit path: error / cancel / retry never reach "finished"
+    _last_percent.pop(key, None)
+    _last_emit.pop(key, None)
 
 def my_hook(d, key=None, socket=None):
     try:
@@ -99,16 +200,22 @@ def my_hook(d, key=None, socket=None):
             percent = downloaded / total * 100 if total > 0 else 0
             percent_rounded = round(percent, 2)
 
+            # log every 10%
             last = _last_percent.get(key, -1)
-            if abs(percent_rounded - last) < 10:
+            if abs(percent_rounded - last) >= 10:
+                _last_percent[key] = percent_rounded
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("Downloading %s: %s%%", filename, percent_rounded)
+
+            # emit by wall clock; first tick always goes out
+            now = time.monotonic()
+            if key in _last_emit and now - _last_emit[key] < _EMIT_INTERVAL:
                 return
-            _last_percent[key] = percent_rounded
-
-            msg = f"Downloading {filename}: {percent_rounded}%"
-            logger.info(msg)
+            _last_emit[key] = now
 
             if socket and key is not None:
-                socket.emit("download_status", {
+                msg = f"Downloading {filename}: {percent_rounded}%"
+                _queue_progress(socket, key, {
                     "key": key,
                     "status": "downloading",
                     "message": msg,
@@ -118,16 +225,18 @@ def my_hook(d, key=None, socket=None):
         elif status == "finished":
             msg = f"Finished downloading {filename}"
             percent_rounded = 100
-            logger.info(msg)
-            _last_percent.pop(key, None)
+            logger.info("Finished downloading %s", filename)
+            _forget_hook_state(key)
 
             if socket and key is not None:
+                # terminal state: drop queued progress and emit in order
+                _drop_progress(key)
                 socket.emit("download_status", {
                     "key": key,
                     "status": "done",
                     "message": msg,
                     "percent": percent_rounded
-                })
+                }, to=key)
 
     except Exception as e:
         logger.warning("my_hook error: %s", e)
@@ -139,27 +248,57 @@ class ErrorOnlyLogger:
     def error(self, msg): logger.info("yt-dlp error: %s", msg)
 
 
-def _base_ydl_opts(extra: dict | None = None):
-    """
-    Base yt-dlp options.
-    All global logic (cookie, deno, retry, log) lives here.
-    """
-    opts = {
-        "quiet": True,
-        "logger": ErrorOnlyLogger(),
-        "no_warnings": False,
-        "retries": 3,
-        "fragment_retries": 3,
-        "extractor_retries": 3,
-        "retry_sleep_functions": {
-            "http": lambda n: 2 * n,
-            "fragment": lambda n: 2 * n,
-            "extractor": lambda n: 2 * n,
+def _retry_backoff(n):
+    return 2 * n
+
+
+_RETRY_SLEEP = {
+    "http": _retry_backoff,
+    "fragment": _retry_backoff,
+    "extractor": _retry_backoff,
+}
+
+_BASE_OPTS = {
+    "quiet": True,
+    "logger": ErrorOnlyLogger(),
+    "no_warnings": True,
+    "retries": 3,
+    "fragment_retries": 3,
+    "extractor_retries": 3,
+    "retry_sleep_functions": _RETRY_SLEEP,
+    "socket_timeout": int(os.environ.get("YTDL_SOCK_TIMEOUT", "30")),
+    "http_chunk_size": int(os.environ.get("YTDL_CHUNK", str(10 * 1024 * 1024))),
+    "concurrent_fragment_downloads": int(os.environ.get("YTDL_CONCURRENT_FRAGS", "8")),
+    "nocheckcertificate": True,
+    "geo_bypass": True,
+    "http_headers": {"Connection": "keep-alive"},
+    # ios / web_safari responses carry pre-signed URLs: no base.js fetch + eval
+    "extractor_args": {
+        "youtube": {
+            "player_client": ["ios", "web_safari"],
+            "player_skip": ["configs"],
         },
-        "socket_timeout": 30,
-        "nocheckcertificate": True,
-        "geo_bypass": True,
-    }
+    },
+}
+
+_WEB_CLIENT_ARGS = {"youtube": {"player_client": ["web"]}}
+
+# ---------- Impersonation (optional, needs curl_cffi) ----------
+try:
+    import curl_cffi  # noqa: F401
+    from yt_dlp.networking.impersonate import ImpersonateTarget
+    _BASE_OPTS["impersonate"] = ImpersonateTarget.from_str("chrome")
+    logger.info("yt-dlp impersonate = chrome")
+except ImportError:
+    pass
+
+
+def _build_base_opts() -> dict:
+    """
+    Resolve process-wide options (deno, cookie) on top of _BASE_OPTS.
+    Run once at import; reload_base_opts() rebuilds it.
+    """
+    opts = dict(_BASE_OPTS)
 
     # ---------- JS runtime ----------
     if _enable_deno():
@@ -169,143 +308,643 @@ def _base_ydl_opts(extra: dict | None = None):
         logger.info("yt-dlp js_runtimes = deno")
 
     # ---------- Cookie ----------
-    cookie_file = _get_cookie_file()
-    if cookie_file:
-        opts["cookiefile"] = cookie_file
-        logger.info("yt-dlp cookie enabled: %s", cookie_file)
+    # no cookiefile: the shared jar is attached in _get_ydl
+    if _get_cookie_jar() is not None:
+        logger.info("yt-dlp cookie enabled (shared jar)")
     else:
         logger.info("yt-dlp cookie disabled")
 
-    if extra:
-        opts.update(extra)
+    return opts
+
+
+_RESOLVED_OPTS = _build_base_opts()
+
+
+def reload_base_opts():
+    """
+    Re-read COOKIE_PATH / ENABLE_DENO (e.g. after cookies rotate).
+    Pooled YoutubeDL instances are dropped so new ones pick up the jar.
+    """
+    global _RESOLVED_OPTS, _cookie_env_path, _cookie_jar
+
+    with _cookie_lock, _cookie_jar_lock:
+        _cookie_env_path = _UNSET
+        _cookie_jar = None
+
+    _enable_deno.cache_clear()
+    _RESOLVED_OPTS = _build_base_opts()
+    _close_ydl_cache()
+
+
+def _base_ydl_opts(extra: dict | None = None):
+    """
+    Base yt-dlp options (precomputed) with per-call extra merged in.
+    """
+    opts = {**_RESOLVED_OPTS, **(extra or {})}
+
+    if extra and "http_headers" in extra:
+        # merge, so callers adding headers keep the keep-alive default
+        opts["http_headers"] = {**_BASE_OPTS["http_headers"], **extra["http_headers"]}
 
     return opts
 
 
+# ---------- YoutubeDL pool ----------
+# Idle YoutubeDL instances keyed by option signature. Reusing an instance keeps
+# extractors initialised and lets its HTTP handlers reuse keep-alive connections.
+_YDL_CACHE: dict[tuple, list[yt_dlp.YoutubeDL]] = {}
+_ydl_cache_lock = threading.Lock()
+_YDL_CACHE_MAX_KEYS = 32
+_YDL_CACHE_MAX_IDLE = 2
+
+# Progress hooks are bound per call (download key), not part of the cache key.
+_UNKEYED_OPTS = ("progress_hooks",)
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _ydl_signature(opts: dict) -> tuple:
+    return _freeze({k: v for k, v in opts.items() if k not in _UNKEYED_OPTS})
+
+
+def _attach_cookie_jar(ydl, jar):
+    """
+    Share jar with this instance's HTTP handlers.
+    With impersonate set, YoutubeDL.__init__ already built the request
+    director around its own (empty) jar: drop it so it is rebuilt lazily
+    against the shared one.
+    """
+    ydl.cookiejar = jar
+    director = ydl.__dict__.pop("_request_director", None)
+    if director is not None:
+        director.close()
+
+
+@contextlib.contextmanager
+def _get_ydl(opts: dict):
+    """
+    Check out a cached YoutubeDL for these options (or build one),
+    and return it to the pool when done.
+    Instances that raised are closed instead of reused.
+    """
+    sig = _ydl_signature(opts)
+
+    with _ydl_cache_lock:
+        idle = _YDL_CACHE.get(sig)
+        ydl = idle.pop() if idle else None
+
+    if ydl is None:
+        logger.info("Creating new YoutubeDL instance")
+        ydl = yt_dlp.YoutubeDL(opts)
+        jar = _get_cookie_jar()
+        if jar is not None:
+            _attach_cookie_jar(ydl, jar)
+
+    # progress hooks are per call (bound to a download key)
+    ydl._progress_hooks = list(opts.get("progress_hooks") or [])
+
+    try:
+        yield ydl
+    except BaseException:
+        ydl.close()
+        raise
+
+    ydl._progress_hooks = []
+    with _ydl_cache_lock:
+        idle = _YDL_CACHE.setdefault(sig, [])
+        if len(idle) < _YDL_CACHE_MAX_IDLE:
+            idle.append(ydl)
+            ydl = None
+        while len(_YDL_CACHE) > _YDL_CACHE_MAX_KEYS:
+            oldest = next(iter(_YDL_CACHE))
+            for old in _YDL_CACHE.pop(oldest):
+                old.close()
+
+    if ydl is not None:
+        ydl.close()
+
+
+def _close_ydl_cache():
+    with _ydl_cache_lock:
+        for idle in _YDL_CACHE.values():
+            for ydl in idle:
+                ydl.close()
+        _YDL_CACHE.clear()
+
+
+atexit.register(_close_ydl_cache)
+
+
+# ---------- Output path ----------
+_ensured_dirs: set[str] = set()
+
+
+def _ensure_dir(path: str):
+    if path not in _ensured_dirs:
+        os.makedirs(path, exist_ok=True)
+        _ensured_dirs.add(path)
+
+
+# default out_dir of download_video: YTDL_DOWNLOAD_DIR, else downloads/
+# next to the app package (not the CWD). Created on the first download.
+_BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOWNLOAD_DIR = os.path.join(_BASE_DIR, os.environ.get("YTDL_DOWNLOAD_DIR", "downloads"))
+
+
+def is_job_dir(path: str, root: str = DOWNLOAD_DIR) -> bool:
+    """True for a per-job dir download_video made directly under root."""
+    real = os.path.realpath(path)
+    return (
+        os.path.basename(real).startswith("job-")
+        and os.path.dirname(real) == os.path.realpath(root)
+    )
+
+
+# Extension written by FFmpegExtractAudio for each preferredcodec
+_AUDIO_PP_EXTS = {
+    "aac": ".m4a",
+    "m4a": ".m4a",
+    "mp3": ".mp3",
+    "opus": ".opus",
+    "vorbis": ".ogg",
+    "flac": ".flac",
+    "wav": ".wav",
+}
+
+
+def _resolve_output(ydl, info: dict, ydl_opts: dict) -> str:
+    """
+    Path of the file yt-dlp produced.
+    Use the path yt-dlp recorded after postprocessing; only when it is
+    missing rebuild it from the output template (no directory scan).
+    """
+    rd = info.get("requested_downloads") or []
+    filepath = (
+        (rd[-1].get("filepath") if rd else None)
+        or info.get("filepath")
+        or info.get("_filename")
+    )
+    if filepath:
+        return filepath
+
+    base = ydl.prepare_filename(info)
+
+    for pp in ydl_opts.get("postprocessors") or []:
+        if pp.get("key") == "FFmpegExtractAudio":
+            ext = _AUDIO_PP_EXTS.get(pp.get("preferredcodec"))
+            if ext:
+                base = os.path.splitext(base)[0] + ext
+
+    return base
+
+
+# ---------- Info cache ----------
+# get_video_info results (title, projected formats and the raw unprocessed
+# info), so repeat inspects skip extraction and a download right after an
+# inspect skips the metadata round-trip.
+_INFO_TTL = int(os.environ.get("YTDL_INFO_TTL", "600"))
+_INFO_CACHE_MAX = 512
+_info_cache: OrderedDict = OrderedDict()
+_info_cache_lock = threading.Lock()
+
+# Query params that never change which video a URL points to
+_TRACKING_PARAMS = frozenset(("si", "feature", "pp", "t", "fbclid", "gclid"))
+
+
+# Playlist context on a watch URL; dropped when the URL names a video (v=),
+# since downloads run with noplaylist. Otherwise YoutubeIE rejects the URL
+# and every video of the playlist would map to the playlist's key.
+_PLAYLIST_PARAMS = frozenset(("list", "index", "start_radio"))
+
+
+def _canonical_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    pairs = parse_qsl(parts.query, keep_blank_values=True)
+    has_video = any(k == "v" for k, _ in pairs)
+    query = [
+        (k, v) for k, v in pairs
+        if k not in _TRACKING_PARAMS and not k.startswith("utm_")
+        and not (has_video and k in _PLAYLIST_PARAMS)
+    ]
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), ""))
+
+
+@functools.lru_cache(maxsize=1024)
+def _video_key(url: str):
+    """
+    (extractor, video id) for URL without network access;
+    falls back to the canonical URL.
+    """
+    url = _canonical_url(url)
+    for ie in gen_extractor_classes():
+        if ie.ie_key() != "Generic" and ie.suitable(url):
+            vid = ie.get_temp_id(url)
+            return (ie.ie_key(), vid) if vid else url
+    return url
+
+
+def video_key(url: str):
+    """Network-free identity of url (same key the info cache uses)."""
+    return _video_key(url)
+
+
+def _cache_info(url: str, result: dict, raw_info: dict):
+    key = _video_key(url)
+    with _info_cache_lock:
+        _info_cache[key] = (time.monotonic() + _INFO_TTL, result, raw_info)
+        _info_cache.move_to_end(key)
+        while len(_info_cache) > _INFO_CACHE_MAX:
+            _info_cache.popitem(last=False)
+
+
+def _cached_info(url: str) -> tuple[dict, dict] | None:
+    """(get_video_info result, raw info) for url, if cached and fresh."""
+    key = _video_key(url)
+    with _info_cache_lock:
+        entry = _info_cache.get(key)
+        if entry is None:
+            return None
+        expires, result, raw_info = entry
+        if expires < time.monotonic():
+            del _info_cache[key]
+            return None
+        _info_cache.move_to_end(key)
+        return result, raw_info
+
+
+def _clear_info_cache(url: str | None = None):
+    """Drop the cached entry for url (e.g. stale signatures), or everything."""
+    key = _video_key(url) if url is not None else None
+    with _info_cache_lock:
+        if key is None:
+            _info_cache.clear()
+        else:
+            _info_cache.pop(key, None)
+
+
 # ---------- Public APIs ----------
+# Format fields returned to the UI (filesize is merged separately)
+_FMT_KEYS = ("format_id", "ext", "format", "format_note", "acodec", "vcodec", "height", "width", "tbr")
+
+
+def _inspect(ydl, url: str) -> dict:
+    # process=False: skip format selection / URL resolution,
+    # the listing only needs the raw format metadata
+    info = ydl.extract_info(url, download=False, process=False)
+    if not info.get("formats"):
+        # url / url_transparent results still need resolving
+        info = ydl.process_ie_result(info, download=False)
+
+    title = info.get("title") or "download"
+    formats = [
+        dict(
+            zip(_FMT_KEYS, map(f.get, _FMT_KEYS)),
+            filesize=f.get("filesize") or f.get("filesize_approx"),
+        )
+        for f in info.get("formats", ())
+    ]
+    # process=False leaves extractor order: best first, audio-only last
+    formats.sort(key=lambda f: (f["height"] or 0, f["tbr"] or 0), reverse=True)
+
+    logger.info("Found %d formats for %s", len(formats), title)
+    # the full info dict only lives in the cache (reused by download_video)
+    result = {"title": title, "formats": formats}
+    _cache_info(url, result, info)
+    return result
+
+
 def get_video_info(url: str):
     logger.info("Inspecting URL: %s", url)
 
+    cached = _cached_info(url)
+    if cached:
+        logger.info("Using cached info for %s", url)
+        return cached[0]
+
     ydl_opts = _base_ydl_opts({"noplaylist": True})
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-
-            title = info.get("title") or "download"
-            formats = []
-
-            for f in info.get("formats", []):
-                formats.append({
-                    "format_id": f.get("format_id"),
-                    "ext": f.get("ext"),
-                    "format": f.get("format"),
-                    "format_note": f.get("format_note"),
-                    "acodec": f.get("acodec"),
-                    "vcodec": f.get("vcodec"),
-                    "height": f.get("height"),
-                    "width": f.get("width"),
-                    "filesize": f.get("filesize") or f.get("filesize_approx"),
-                    "tbr": f.get("tbr"),
-                })
-
-            logger.info("Found %d formats for %s", len(formats), title)
-            return {
-                "title": title,
-                "formats": formats,
-                "info": info,
-            }
+        try:
+            with _get_ydl(ydl_opts) as ydl:
+                return _inspect(ydl, url)
+        except (DownloadError, ExtractorError) as e:
+            # some videos only list formats for the web client
+            logger.warning("Inspect failed, retrying with web client: %s", e)
+            with _get_ydl({**ydl_opts, "extractor_args": _WEB_CLIENT_ARGS}) as ydl:
+                return _inspect(ydl, url)
 
     except Exception as e:
         logger.exception("get_video_info failed for URL: %s", url)
         raise RuntimeError(f"Failed to get video info: {e}")
 
 
+@contextlib.contextmanager
+def _attempt_opts(ydl, fopt: dict):
+    """
+    Apply one attempt's format options to a live YoutubeDL, then restore it.
+    format and postprocessors are compiled at construction time, so the
+    format selector and postprocessor chain are rebuilt as well.
+    """
+    saved_params = {k: ydl.params[k] for k in fopt if k in ydl.params}
+    missing = [k for k in fopt if k not in ydl.params]
+    saved_selector = ydl.format_selector
+    saved_pps = {when: list(pps) for when, pps in ydl._pps.items()}
+
+    try:
+        for k, v in fopt.items():
+            if k != "postprocessors":
+                ydl.params[k] = v
+
+        if "format" in fopt:
+            ydl.format_selector = ydl.build_format_selector(fopt["format"])
+
+        for pp_def in fopt.get("postprocessors") or []:
+            pp_def = dict(pp_def)
+            when = pp_def.pop("when", "post_process")
+            ydl.add_post_processor(get_postprocessor(pp_def.pop("key"))(ydl, **pp_def), when=when)
+
+        yield ydl
+
+    finally:
+        ydl.params.update(saved_params)
+        for k in missing:
+            ydl.params.pop(k, None)
+        ydl.format_selector = saved_selector
+        for when, pps in saved_pps.items():
+            ydl._pps[when] = pps
+
+
+def _is_drc(f: dict) -> bool:
+    # YouTube's dynamic-range-compressed audio copies, e.g. itag 140-drc
+    return "drc" in (f.get("format_id") or "").lower() or "drc" in (f.get("format_note") or "").lower()
+
+
+def _pick_best_mp4(formats: list[dict]) -> str | None:
+    """
+    "<video_id>+<audio_id>" for the best SDR avc1 mp4 video-only stream and
+    the original-language m4a audio among known formats, or None.
+    Same codec choice as the video ladder: stream-copy merge into mp4.
+    """
+    videos = [
+        f for f in formats
+        if f.get("ext") == "mp4"
+        and (f.get("vcodec") or "").startswith("avc1")
+        and f.get("acodec") == "none"
+        and f.get("dynamic_range") in (None, "SDR")
+    ]
+    audios = [
+        f for f in formats
+        if f.get("vcodec") == "none"
+        and f.get("ext") == "m4a"
+        and (f.get("acodec") or "").startswith("mp4a")
+        and not _is_drc(f)
+    ]
+    if not videos or not audios:
+        return None
+
+    video = max(videos, key=lambda f: (f.get("height") or 0, f.get("fps") or 0, f.get("tbr") or 0))
+    # original / default track first (yt-dlp ranks it by language_preference),
+    # not a dubbed one
+    audio = max(audios, key=lambda f: (
+        f.get("language_preference") if f.get("language_preference") is not None else -1,
+        "original" in (f.get("format_note") or "").lower(),
+        f.get("tbr") or 0,
+    ))
+    return f"{video['format_id']}+{audio['format_id']}"
+
+
+_TRANSIENT_STATUS = (403, 429, 500, 502, 503, 504)
+
+
+def _error_chain(e: BaseException | None):
+    """e and the errors it wraps (DownloadError -> ExtractorError -> HTTPError)."""
+    for _ in range(5):
+        if e is None:
+            return
+        yield e
+        exc_info = getattr(e, "exc_info", None)
+        e = (exc_info[1] if exc_info else None) or getattr(e, "cause", None) or e.__cause__
+
+
+def _http_status(e: BaseException) -> int | None:
+    """
+    HTTP status behind a yt-dlp error, by walking the wrapped causes,
+    not str(e).
+    """
+    for err in _error_chain(e):
+        if isinstance(err, HTTPError):
+            return err.status
+    return None
+
+
+# signed media URLs expired / revoked: the cached info is stale
+_STALE_STATUS = (403, 410)
+
+
+def _is_stale(e: BaseException) -> bool:
+    return _http_status(e) in _STALE_STATUS
+
+
+def _is_transient(e: BaseException) -> bool:
+    """Rate limits, 5xx and network timeouts; not 404 / geo / removed."""
+    if _http_status(e) in _TRANSIENT_STATUS:
+        return True
+    return any(isinstance(err, (TransportError, TimeoutError)) for err in _error_chain(e))
+
+
+_BACKOFF_BASE = 0.5
+_BACKOFF_MAX = 10.0
+
+
+def _backoff_delay(attempt: int, e: BaseException) -> float:
+    """Exponential backoff with jitter; 429 starts from a longer delay."""
+    delay = _BACKOFF_BASE * (2 ** attempt)
+    if _http_status(e) == 429:
+        delay = max(delay, 5.0)
+    return min(_BACKOFF_MAX, delay) * (0.5 + random.random())
+
+
+def _run_download(ydl, url: str, cached: dict | None) -> dict:
+    """
+    Download from cached info when available (no second extraction),
+    otherwise extract + download.
+    """
+    if cached:
+        # process_ie_result mutates its input; keep the cache entry pristine.
+        # deepcopy, not sanitize_info: that stringifies callables (live fragments)
+        return ydl.process_ie_result(copy.deepcopy(cached), download=True)
+    return ydl.extract_info(url, download=True)
+
+
+_AAC_EXTRACT = [{
+    "key": "FFmpegExtractAudio",
+    "preferredcodec": "m4a",
+    "preferredquality": "192",
+}]
+
+def _extracts_aac(fopt: dict) -> bool:
+    return any(
+        pp.get("key") == "FFmpegExtractAudio" and pp.get("preferredcodec") in ("aac", "m4a")
+        for pp in fopt.get("postprocessors") or ()
+    )
+
+
+# merged mp4 is served as-is when it is avc1 + aac: moov up front for seeking
+_MERGE_MP4 = {
+    "merge_output_format": "mp4",
+    "postprocessor_args": {"merger": ["-movflags", "+faststart"]},
+}
+
+_AUDIO_ARIA2C = _aria2c_opts(["-x", "16", "-s", "16", "-k", "1M"])
+
+# Format fallback ladders, tried in order
+_FORMAT_LADDERS = {
+    "audio": [
+        {"format": "140", **_AUDIO_ARIA2C},  # m4a
+        {"format": "251", "postprocessors": _AAC_EXTRACT, **_AUDIO_ARIA2C},
+        {"format": "bestaudio/best", "postprocessors": _AAC_EXTRACT, **_AUDIO_ARIA2C},
+    ],
+    # source stream as-is: the caller transcodes it
+    "audio_raw": [
+        {"format": "140", **_AUDIO_ARIA2C},
+        {"format": "251", **_AUDIO_ARIA2C},
+        {"format": "bestaudio/best", **_AUDIO_ARIA2C},
+    ],
+    "video": [
+        # mp4/avc1 + m4a merges into mp4 by stream copy, no transcode
+        {
+            "format": "bestvideo[ext=mp4][vcodec^=avc1]+bestaudio[ext=m4a]/bestvideo+bestaudio/best",
+            **_MERGE_MP4,
+        },
+        {
+            "format": "best",
+            # single progressive file: let aria2c split it into ranges
+            **_aria2c_opts(["-x", "8", "-s", "8", "-k", "1M", "--file-allocation=none"]),
+        },
+    ],
+    "explicit": lambda fid: [{"format": fid}],
+}
+
+
 def download_video(
     url: str,
-    out_dir: str = "downloads",
+    out_dir: str = DOWNLOAD_DIR,
     format_id: str | None = None,
     audio_only: bool = False,
     key: str | None = None,
-    socket=None
+    socket=None,
+    audio_codec: str = "copy",
 ):
     """
     Download video or audio using yt-dlp.
     Always download fresh, no check file exist.
+    audio_codec other than "copy": audio is not extracted to m4a here,
+    the caller encodes the source stream itself.
+    Each call writes into its own directory under out_dir (.part files,
+    merge parts and pre-extraction sources never meet another job's),
+    returned as "job_dir"; the caller moves the result out and removes it.
+    On failure the directory is removed here.
     """
 
-    import functools
-    os.makedirs(out_dir, exist_ok=True)
-
     logger.info(
         "Download called | url=%s | format_id=%s | audio_only=%s",
         url, format_id, audio_only,
     )
 
-    try_opts_list = []
+    cached = _cached_info(url)
+    if cached:
+        logger.info("Using cached info for %s", url)
+        cached = cached[1]
 
     # ---------- Build format options ----------
     if audio_only:
-        formats_to_try = [
-            {"format": "140"},  # m4a
-            {
-                "format": "251",
-                "postprocessors": [{
-                    "key": "FFmpegExtractAudio",
-                    "preferredcodec": "aac",
-                    "preferredquality": "192",
-                }]
-            },
-            {
-                "format": "bestaudio/best",
-                "postprocessors": [{
-                    "key": "FFmpegExtractAudio",
-                    "preferredcodec": "aac",
-                    "preferredquality": "192",
-                }]
-            },
-        ]
+        formats_to_try = _FORMAT_LADDERS["audio" if audio_codec == "copy" else "audio_raw"]
     elif format_id:
-        formats_to_try = [{"format": format_id}]
+        formats_to_try = _FORMAT_LADDERS["explicit"](format_id)
     else:
-        formats_to_try = [
-            {"format": "bestvideo+bestaudio/best", "merge_output_format": "mp4"},
-            {"format": "best"},
-        ]
+        formats_to_try = _FORMAT_LADDERS["video"]
+        # known formats: go straight for a concrete pair, ladder as fallback
+        chosen = _pick_best_mp4(cached["formats"]) if cached else None
+        if chosen:
+            formats_to_try = [{"format": chosen, **_MERGE_MP4}, *formats_to_try]
+
+    # same ladder again on the web client, as get_video_info falls back:
+    # some videos only list (or serve) formats there
+    formats_to_try = [
+        *formats_to_try,
+        *({**f, "extractor_args": _WEB_CLIENT_ARGS} for f in formats_to_try),
+    ]
 
     # ---------- Prepare yt-dlp options ----------
-    for fopt in formats_to_try:
-        outtmpl = f"{out_dir}/%(title)s.%(format_id)s.%(ext)s"
-        ydl_opts = _base_ydl_opts({
-            "outtmpl": outtmpl,
-            "noplaylist": True,
-            **fopt
-        })
-        try_opts_list.append(ydl_opts)
+    # one YoutubeDL serves every attempt; attempts only patch format options
+    base_opts = _base_ydl_opts({
+        "outtmpl": "%(title)s.%(format_id)s.%(ext)s",
+        # stable for the pool signature; each attempt points it at job_dir
+        "paths": {"home": out_dir},
+        "noplaylist": True,
+        "progress_hooks": [functools.partial(my_hook, key=key, socket=socket)],
+    })
 
     # ---------- Download loop ----------
-    for ydl_opts in try_opts_list:
-        try:
-            logger.info("Trying format: %s", ydl_opts.get("format"))
-            ydl_opts["progress_hooks"] = [functools.partial(my_hook, key=key, socket=socket)]
-
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                title = info.get("title") or "download"
-
-                if info.get("_filename"):
-                    filepath = info["_filename"]
-                elif info.get("requested_downloads"):
-                    # fallback: lấy filepath của download đầu tiên
-                    filepath = info["requested_downloads"][0].get("filepath") or ydl.prepare_filename(info)
-                else:
-                    filepath = ydl.prepare_filename(info)
-
-                logger.info("Downloaded file: %s", filepath)
-                return {"title": title, "filepath": filepath}
-
-        except (DownloadError, ExtractorError, Exception) as e:
-            logger.warning("Attempt failed: %s", e)
-            continue
+    _ensure_dir(out_dir)
+    job_dir = tempfile.mkdtemp(prefix="job-", dir=out_dir)
+    try:
+        last_err = None
+        with _get_ydl(base_opts) as ydl:
+            for attempt, fopt in enumerate(formats_to_try):
+                try:
+                    logger.info("Trying format: %s", fopt.get("format"))
+
+                    with _attempt_opts(ydl, {**fopt, "paths": {"home": job_dir}}):
+                        # cached info came from the default client: re-extract
+                        info = _run_download(ydl, url, None if "extractor_args" in fopt else cached)
+                        title = info.get("title") or "download"
+                        filepath = _resolve_output(ydl, info, fopt)
+
+                    acodec, vcodec = info.get("acodec"), info.get("vcodec")
+                    if _extracts_aac(fopt):
+                        # info still describes the source stream, not the m4a output
+                        acodec, vcodec = "aac", "none"
+
+                    logger.info("Downloaded file: %s", filepath)
+                    return {
+                        "title": title,
+                        "filepath": filepath,
+                        "ext": info.get("ext"),
+                        "acodec": acodec,
+                        "vcodec": vcodec,
+                        "duration": info.get("duration"),
+                        "job_dir": job_dir,
+                    }
+
+                except (DownloadError, ExtractorError) as e:
+                    logger.warning("Attempt failed: %s", e)
+                    last_err = e
+                    if _is_transient(e) and attempt + 1 < len(formats_to_try):
+                        # back off before the next format; permanent errors move on
+                        time.sleep(_backoff_delay(attempt, e))
+                    if cached and _is_stale(e):
+                        # expired signed URLs: re-extract from now on. Other errors
+                        # (e.g. "Requested format is not available") keep the cache
+                        _clear_info_cache(url)
+                        cached = None
+                    continue
+
+        raise RuntimeError("Failed to download after all retries") from last_err
+
+    except BaseException:
+        # no job has recorded job_dir yet: nothing else would remove it
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise
+
+    finally:
+        _forget_hook_state(key)
+        # the caller emits processing / error next
+        _drop_progress(key)
 
-    raise RuntimeError("Failed to download after all retries")
@@ -1,24 +1,44 @@
 # app.log_config.py
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
 
-class FlushStreamHandler(logging.StreamHandler):
-    """StreamHandler mà flush ngay sau mỗi emit"""
+class BatchFlushStreamHandler(logging.StreamHandler):
+    """StreamHandler chỉ flush khi queue đã rỗng (gom nhiều record/1 lần flush)"""
+    def __init__(self, stream, pending: queue.Queue):
+        super().__init__(stream)
+        self._pending = pending
+
     def emit(self, record):
-        super().emit(record)
-        self.flush()
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+            return
+        if self._pending.empty():
+            self.flush()
+
+# Loggers chỉ enqueue record; một listener thread ghi ra stdout.
+# queue.Queue (không phải SimpleQueue) để eventlet monkey patch được.
+_log_queue = queue.Queue(-1)
+
+_stream_handler = BatchFlushStreamHandler(sys.stdout, _log_queue)
+_stream_handler.setFormatter(logging.Formatter('[%(name)s] %(levelname)s: %(message)s'))
+
+_listener = logging.handlers.QueueListener(_log_queue, _stream_handler)
+_listener.start()
+atexit.register(_listener.stop)
 
 def setup_logger(name: str, level=logging.INFO) -> logging.Logger:
     """
-    Tạo logger với FlushStreamHandler, dùng chung cho toàn app.
+    Tạo logger ghi qua QueueHandler, dùng chung cho toàn app.
     """
     logger = logging.getLogger(name)
     logger.setLevel(level)
 
     if not logger.hasHandlers():
-        ch = FlushStreamHandler(sys.stdout)
-        formatter = logging.Formatter('[%(name)s] %(levelname)s: %(message)s')
-        ch.setFormatter(formatter)
-        logger.addHandler(ch)
+        logger.addHandler(logging.handlers.QueueHandler(_log_queue))
 
-    return logger
\ No newline at end of file
+    return logger
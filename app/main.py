@@ -1,24 +1,78 @@
+import eventlet
+
+if __name__ == "__main__":
+    # direct run: no gunicorn eventlet worker patches for us, so patch before
+    # anything below creates threads, locks or sockets
+    eventlet.monkey_patch()
+
 import os
+import re
 import time
-import uuid
-import traceback
+import string
+import codecs
+import mimetypes
+import stat
+import shutil
+import secrets
+import logging
 import subprocess
+import tempfile
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
-import eventlet
 from eventlet import tpool
 
-from flask import Flask, request, jsonify, send_from_directory, Response, make_response
-from flask_socketio import SocketIO
+from flask import Flask, request, jsonify, send_file, send_from_directory, Response, make_response
+from flask_socketio import SocketIO, emit, join_room
 from app.log_config import setup_logger
 
 # ---------- App setup ----------
 app = Flask(__name__, static_folder="static", static_url_path="")
 app.secret_key = os.environ.get("FLASK_SECRET", "change-me")
 
+# ---------- JSON (optional, needs orjson) ----------
+_socketio_opts = {}
+try:
+    import orjson
+    from flask.json.provider import DefaultJSONProvider
+
+    class OrjsonProvider(DefaultJSONProvider):
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, default=self.default).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    class _OrjsonModule:
+        # python-socketio calls json.dumps(data, separators=...) and expects str
+        @staticmethod
+        def dumps(obj, **kwargs):
+            return orjson.dumps(obj).decode()
+
+        @staticmethod
+        def loads(s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = OrjsonProvider(app)
+    _socketio_opts["json"] = _OrjsonModule
+except ImportError:
+    pass
+
+# e.g. redis://redis:6379/0 (redis package, see requirements.txt):
+# emits fan out to every worker / process
+# (job state stays per process, so /status and /cancel need sticky sessions)
+if os.environ.get("SOCKETIO_MESSAGE_QUEUE"):
+    _socketio_opts["message_queue"] = os.environ["SOCKETIO_MESSAGE_QUEUE"]
+
 socketio = SocketIO(
     app,
     cors_allowed_origins="*",
     async_mode="eventlet",   # Gunicorn will handle eventlet
+    async_handlers=True,     # each event handler in its own greenlet
+    ping_interval=int(os.environ.get("SOCKETIO_PING_INTERVAL", "25")),
+    ping_timeout=int(os.environ.get("SOCKETIO_PING_TIMEOUT", "20")),
+    **_socketio_opts,
 )
 
 logger = setup_logger("main")
@@ -26,56 +80,464 @@ logger.info("Logger initialized")
 
 
 def _new_key():
-    return uuid.uuid4().hex
+    return secrets.token_hex(16)
+
+
+# ---------- Download jobs ----------
+# Bounded pools: network-bound downloads and ffmpeg processing are separate,
+# so a burst of downloads can't starve processing of finished ones.
+_DL_POOL = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("YTDL_MAX_CONCURRENCY", "4")),
+    thread_name_prefix="ytdl",
+)
+_PP_WORKERS = int(os.environ.get("YTDL_PP_CONCURRENCY", "2"))
+_PP_POOL = ThreadPoolExecutor(
+    max_workers=_PP_WORKERS,
+    thread_name_prefix="ytdl-pp",
+)
+
+# Job state sharded by key: each shard is its own dict + lock, so status
+# updates for different jobs don't contend on one global lock.
+_DOWNLOAD_SHARDS = 16
+_downloads = [({}, threading.Lock()) for _ in range(_DOWNLOAD_SHARDS)]
+
+
+def _shard(key: str):
+    return _downloads[hash(key) % _DOWNLOAD_SHARDS]
+
+
+_TERMINAL_STATUSES = ("done", "error", "cancelled")
+_DOWNLOAD_TTL = int(os.environ.get("YTDL_JOB_TTL", "3600"))
+_REAP_INTERVAL = 300
+
+
+# (video key, format_id, audio_only) -> key of the job producing it, so a
+# duplicate submission joins the running job instead of downloading again
+_inflight: dict[tuple, str] = {}
+_inflight_lock = threading.Lock()
+
+
+def _set_download(key: str, data: dict):
+    terminal = data.get("status") in _TERMINAL_STATUSES
+    if terminal:
+        data = {**data, "completed_at": time.monotonic()}
+    jobs, lock = _shard(key)
+    with lock:
+        job = jobs[key] = {**jobs.get(key, {}), **data}
+
+    if terminal and "sig" in job:
+        with _inflight_lock:
+            if _inflight.get(job["sig"]) == key:
+                del _inflight[job["sig"]]
+
+
+def _add_subscriber(key: str) -> str:
+    """Register one more client on key's job; returns its cancel token."""
+    token = secrets.token_hex(8)
+    jobs, lock = _shard(key)
+    with lock:
+        job = jobs.get(key, {})
+        jobs[key] = {**job, "subscribers": job.get("subscribers", frozenset()) | {token}}
+    return token
+
+
+def _drop_subscriber(key: str, token: str | None) -> int | None:
+    """Remove token from key's job; remaining count, None if not subscribed."""
+    jobs, lock = _shard(key)
+    with lock:
+        job = jobs.get(key)
+        subs = job.get("subscribers", frozenset()) if job else frozenset()
+        if token not in subs:
+            return None
+        jobs[key] = {**job, "subscribers": subs - {token}}
+        return len(subs) - 1
+
+
+def _claim_inflight(sig: tuple, key: str) -> str:
+    """key of the in-flight job for sig; claims sig for key if there is none."""
+    with _inflight_lock:
+        return _inflight.setdefault(sig, key)
+
+
+def _get_download(key: str) -> dict | None:
+    jobs, lock = _shard(key)
+    with lock:
+        return jobs.get(key)
+
+
+def _iter_downloads():
+    """Snapshot of all jobs, one shard lock at a time."""
+    for jobs, lock in _downloads:
+        with lock:
+            items = list(jobs.items())
+        yield from items
+
+
+def _reap_downloads():
+    """
+    Drop jobs finished more than _DOWNLOAD_TTL ago, with their per-job
+    download dir in downloads/ (the aac/ output is kept).
+    """
+    while True:
+        socketio.sleep(_REAP_INTERVAL)
+        cutoff = time.monotonic() - _DOWNLOAD_TTL
+
+        for key, job in _iter_downloads():
+            if job.get("completed_at", cutoff) >= cutoff:
+                continue
+
+            jobs, lock = _shard(key)
+            with lock:
+                jobs.pop(key, None)
+
+            job_dir = job.get("job_dir")
+            if not job_dir:
+                continue
+            # only jobs that downloaded have a job_dir: already imported
+            from app.downloader import is_job_dir
+            if not is_job_dir(job_dir):
+                logger.warning("Not removing %s: not a job dir under downloads/", job_dir)
+                continue
+            try:
+                shutil.rmtree(job_dir)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Failed to remove %s: %s", job_dir, e)
+
+
+socketio.start_background_task(_reap_downloads)
 
 
 # ---------- File processor ----------
+_FFMPEG_TIMEOUT = int(os.environ.get("FFMPEG_TIMEOUT", "600"))
+
+
 def _run_ffmpeg(cmd):
-    return subprocess.run(cmd, capture_output=True, text=True)
+    # runs in a tpool thread: no logging / socket emits in here
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        _, stderr = proc.communicate(timeout=_FFMPEG_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        _, stderr = proc.communicate()
+        stderr += f"\nffmpeg timed out after {_FFMPEG_TIMEOUT}s".encode()
+    return subprocess.CompletedProcess(cmd, proc.returncode, None, stderr)
+
+
+_PROGRESS_INTERVAL = 1.0
+
+
+def _run_ffmpeg_progress(cmd, on_progress):
+    """
+    _run_ffmpeg with ffmpeg's -progress key=value stream on stdout;
+    on_progress(seconds_done) is called at most once per second.
+    Runs in the calling (green) thread, not tpool: the monkey-patched
+    subprocess pipes yield to the hub, and on_progress may emit.
+    """
+    cmd = [cmd[0], "-progress", "pipe:1", *cmd[1:]]
+    # stderr to a file, not a second pipe: a full stderr pipe would block
+    # ffmpeg while we are still waiting on stdout
+    err = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=err)
+
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        proc.kill()
+
+    timer = threading.Timer(_FFMPEG_TIMEOUT, kill)
+    timer.start()
+    last = 0.0
+    try:
+        for line in proc.stdout:
+            if not line.startswith(b"out_time_us="):
+                continue
+            now = time.monotonic()
+            if now - last < _PROGRESS_INTERVAL:
+                continue
+            last = now
+            try:
+                on_progress(int(line[12:]) / 1e6)
+            except ValueError:
+                # "N/A" before the first frame
+                pass
+        proc.wait()
+        err.seek(0)
+        stderr = err.read()
+    finally:
+        timer.cancel()
+        err.close()
+
+    if timed_out.is_set():
+        stderr += f"\nffmpeg timed out after {_FFMPEG_TIMEOUT}s".encode()
+    return subprocess.CompletedProcess(cmd, proc.returncode, None, stderr)
+
+
+_ensured_dirs: set[str] = set()
+
+
+def _ensure_dir(path: str):
+    if path not in _ensured_dirs:
+        os.makedirs(path, exist_ok=True)
+        _ensured_dirs.add(path)
+
+
+_FFMPEG = ["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-nostats"]
+# encoder tuning below applies to audio_codec="aac" jobs (see /download)
+_AAC_BITRATE = os.environ.get("YTDL_AAC_BITRATE", "192k")
+# split the cores between concurrent ffmpeg jobs instead of oversubscribing
+_FFMPEG_THREADS = os.environ.get("FFMPEG_THREADS") or str(max(1, (os.cpu_count() or 1) // _PP_WORKERS))
+
+
+@functools.lru_cache(maxsize=1)
+def _aac_encoder() -> str:
+    """libfdk_aac when this ffmpeg build has it (faster, better), else aac."""
+    try:
+        out = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            stdin=subprocess.DEVNULL, capture_output=True, timeout=10,
+        ).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return "aac"
+    encoder = "libfdk_aac" if b"libfdk_aac" in out else "aac"
+    logger.info("AAC encoder = %s", encoder)
+    return encoder
+
+
+def _aac_encode(src_path, dst):
+    # -vn: never decode attached cover art / video
+    return [*_FFMPEG, "-threads", _FFMPEG_THREADS, "-i", src_path, "-vn", "-map", "0:a",
+            "-c:a", _aac_encoder(), "-b:a", _AAC_BITRATE, "-y", dst]
+
+
+_MP4_EXTS = (".mp4", ".m4a")
+
+
+def _mux_flags(dst):
+    # moov atom up front: the served file can start playing / seek over ranges
+    return ["-movflags", "+faststart"] if dst.endswith(_MP4_EXTS) else []
 
-def process_file(src_path: str, dst_dir: str, audio_only: bool, key: str, title: str):
-    DST_DIR = "/app/download"
-    full_dir = os.path.join(DST_DIR, dst_dir)
-    os.makedirs(full_dir, exist_ok=True)
 
-    filename = os.path.basename(src_path)
-    name, ext = os.path.splitext(filename)
+def _mp4_cmd(src_path, stem, audio_only, audio_codec):
+    if not audio_only:
+        return _copy_cmd(src_path, stem + ".mp4", audio_only, audio_codec)
+    if audio_codec == "copy":
+        # drop the video, keep the original (AAC) audio stream
+        dst = f"{stem}.m4a"
+        return dst, [*_FFMPEG, "-i", src_path, "-map", "0:a", "-c", "copy", *_mux_flags(dst), "-y", dst], "audio"
+    dst = f"{stem}.aac"
+    return dst, _aac_encode(src_path, dst), None
+
+
+def _m4a_cmd(src_path, stem, audio_only, audio_codec):
+    dst = f"{stem}.aac"
+    return dst, [*_FFMPEG, "-i", src_path, "-c", "copy", "-y", dst], "all"
+
+
+def _opus_cmd(src_path, stem, audio_only, audio_codec):
+    if audio_codec == "copy":
+        # remux only, keep the original Opus stream
+        dst = f"{stem}.opus"
+        return dst, [*_FFMPEG, "-i", src_path, "-map", "0:a", "-c", "copy", "-y", dst], "audio"
+    dst = f"{stem}.aac"
+    return dst, _aac_encode(src_path, dst), None
 
-    name = name[:70]
-    ext = ext.lower()
 
-    dst = os.path.join(full_dir, f"{name}{ext}")
+def _webm_cmd(src_path, stem, audio_only, audio_codec):
+    if not audio_only:
+        return _copy_cmd(src_path, stem + ".webm", audio_only, audio_codec)
+    # YouTube webm audio is Opus
+    return _opus_cmd(src_path, stem, audio_only, audio_codec)
 
-    if ext == ".mp4" and audio_only:
-        dst = os.path.join(full_dir, f"{name}.aac")
-        cmd = ["ffmpeg", "-i", src_path, "-map", "a", "-c:a", "aac", "-b:a", "192k", "-y", dst]
 
-    elif ext == ".m4a":
-        dst = os.path.join(full_dir, f"{name}.aac")
-        cmd = ["ffmpeg", "-i", src_path, "-c", "copy", "-y", dst]
+def _copy_cmd(src_path, dst, audio_only, audio_codec):
+    return dst, [*_FFMPEG, "-i", src_path, "-c", "copy", *_mux_flags(dst), "-y", dst], "all"
 
-    elif ext == ".opus":
-        dst = os.path.join(full_dir, f"{name}.aac")
-        cmd = ["ffmpeg", "-i", src_path, "-map", "a", "-c:a", "aac", "-b:a", "192k", "-y", dst]
 
-    else:
-        cmd = ["ffmpeg", "-i", src_path, "-c", "copy", "-y", dst]
+# source extension -> (src, stem, audio_only, audio_codec) -> (dst, cmd, remux)
+# remux: streams a pure stream copy keeps ("audio" / "all"), None if it encodes
+_CMD_TABLE = {
+    ".mp4": _mp4_cmd,
+    ".m4a": _m4a_cmd,
+    ".opus": _opus_cmd,
+    ".webm": _webm_cmd,
+}
+
+# ---------- In-process remux (optional, needs PyAV) ----------
+# Stream copies run in libavformat directly: no ffmpeg fork/exec per job.
+try:
+    import av
+
+    def _remux_streams(src_path: str, dst: str, streams: str):
+        # runs in a tpool thread: no logging / socket emits here
+        options = {"movflags": "+faststart"} if dst.endswith(_MP4_EXTS) else {}
+        with av.open(src_path) as inp, av.open(dst, mode="w", options=options) as out:
+            if streams == "audio":
+                selected = list(inp.streams.audio)
+            else:
+                selected = [st for st in inp.streams if st.type in ("audio", "video")]
+
+            add = getattr(out, "add_stream_from_template", None)
+            mapping = {
+                st.index: add(st) if add else out.add_stream(template=st)
+                for st in selected
+            }
+
+            for packet in inp.demux(selected):
+                if packet.dts is None:
+                    # demuxer flush packet
+                    continue
+                packet.stream = mapping[packet.stream.index]
+                out.mux(packet)
+
+except ImportError:
+    _remux_streams = None
+
+# characters quote() leaves untouched
+_URL_SAFE = frozenset(string.ascii_letters + string.digits + "_.-~")
+
+
+def _url_name(file_name: str) -> str:
+    if _URL_SAFE.issuperset(file_name):
+        return file_name
+    return quote(file_name)
+
+
+# "-<key[:8]>" that process_file appends to the stem
+_JOB_SUFFIX = re.compile(r"-[0-9a-f]{8}(?=\.[^.]*$|$)")
+
+
+def _download_name(file_name: str) -> str:
+    """User-facing name of an output file: without the per-job suffix."""
+    return _JOB_SUFFIX.sub("", file_name, count=1)
+
+
+_AAC_CODECS = ("aac", "mp4a")
+
 
-    
-    proc = tpool.execute(_run_ffmpeg, cmd)
-    if proc.returncode != 0:
-        raise RuntimeError(f"FFmpeg failed: {proc.stderr}")
+def _passthrough_dst(stem, ext, audio_only, acodec, vcodec):
+    """
+    Destination when the download already is AAC-in-MP4 (audio, or
+    avc1 + aac video) and only needs moving; None when ffmpeg has to run.
+    Gated on the actual output ext/codecs, not on which attempt produced it.
+    """
+    if not (acodec or "").startswith(_AAC_CODECS):
+        return None
+    if ext == ".m4a" or (ext == ".mp4" and audio_only and vcodec == "none"):
+        return f"{stem}.m4a"
+    if ext == ".mp4" and not audio_only and (vcodec or "").startswith("avc1"):
+        return f"{stem}.mp4"
+    return None
 
-    final_path = dst
+
+_DST_ROOT = "/app/download"
+
+# pre-create the output dir once; process_file re-checks lazily
+try:
+    _ensure_dir(os.path.join(_DST_ROOT, "aac"))
+except OSError as e:
+    logger.warning("Cannot create %s: %s", _DST_ROOT, e)
+
+
+def _publish(key: str, title: str, final_path: str):
     file_name = os.path.basename(final_path)
-    safe_name = quote(file_name)
+    safe_name = _url_name(file_name)
+
+    download_url = f"/download/aac/{safe_name}"
+    download_name = _download_name(file_name)
+    _set_download(key, {
+        "status": "done",
+        "download_url": download_url,
+        "download_name": download_name,
+        "title": title,
+    })
 
     socketio.emit("download_complete", {
             "key": key,
             "status": "done",
             "title": title,
-            "download_url": f"/download/aac/{safe_name}"
-        })
+            "download_url": download_url,
+            "download_name": download_name,
+        }, to=key)
+
+
+def process_file(
+    src_path: str,
+    dst_dir: str,
+    audio_only: bool,
+    key: str,
+    title: str,
+    audio_codec: str = "copy",
+    acodec: str | None = None,
+    vcodec: str | None = None,
+    duration: float | None = None,
+):
+    full_dir = os.path.join(_DST_ROOT, dst_dir)
+    _ensure_dir(full_dir)
+
+    filename = os.path.basename(src_path)
+    name, ext = os.path.splitext(filename)
+
+    # key suffix on disk only: same-title jobs never share (or overwrite)
+    # an output; _download_name strips it from what the user sees
+    name = f"{name[:70]}-{key[:8]}"
+    ext = ext.lower()
+
+    stem = os.path.join(full_dir, name)
+    dst = _passthrough_dst(stem, ext, audio_only, acodec, vcodec)
+
+    if dst:
+        # already the right shape: no ffmpeg process at all
+        try:
+            tpool.execute(shutil.move, src_path, dst)
+        except FileNotFoundError:
+            if not os.path.exists(src_path):
+                raise
+            # output dir removed at runtime: recreate and retry once
+            _ensured_dirs.discard(full_dir)
+            _ensure_dir(full_dir)
+            tpool.execute(shutil.move, src_path, dst)
+
+    else:
+        builder = _CMD_TABLE.get(ext)
+        if builder:
+            dst, cmd, remux = builder(src_path, stem, audio_only, audio_codec)
+        else:
+            dst, cmd, remux = _copy_cmd(src_path, stem + ext, audio_only, audio_codec)
+
+        if remux and _remux_streams:
+            try:
+                tpool.execute(_remux_streams, src_path, dst, remux)
+                cmd = None
+            except Exception as e:
+                logger.warning("In-process remux failed, using ffmpeg: %s", e)
+
+        if cmd and not remux and duration:
+            # re-encode: long enough to be worth progress events
+            def on_progress(done):
+                percent = round(min(done / duration * 100, 100), 1)
+                socketio.emit("download_status", {
+                    "key": key,
+                    "status": "processing",
+                    "message": f"Processing... {percent}%",
+                    "percent": percent,
+                }, to=key)
+
+            proc = _run_ffmpeg_progress(cmd, on_progress)
+        elif cmd:
+            proc = tpool.execute(_run_ffmpeg, cmd)
+
+        # -loglevel error: stderr is empty on a clean run, decode only if not
+        if cmd and (proc.returncode != 0 or proc.stderr):
+            stderr = proc.stderr.decode("utf-8", errors="replace").strip()
+            if proc.returncode != 0:
+                raise RuntimeError(f"FFmpeg failed: {stderr}")
+            for line in stderr.splitlines():
+                logger.warning("ffmpeg: %s", line)
+
+    _publish(key, title, dst)
 
 
 # ---------- Routes ----------
@@ -108,6 +570,12 @@ def inspect():
     })
 
 
+# "copy" keeps the source audio; "aac" re-encodes it here (tuned encoder,
+# progress events) instead of in yt-dlp's extract step
+_AUDIO_CODECS = ("copy", "aac")
+_DEFAULT_AUDIO_CODEC = os.environ.get("YTDL_AUDIO_CODEC", "copy")
+
+
 @app.route("/download", methods=["POST"])
 def download():
     data = request.json or request.form
@@ -115,83 +583,231 @@ def download():
     url = data.get("url")
     format_id = data.get("format_id")
     audio_only = str(data.get("audio_only", "0")) == "1"
+    audio_codec = data.get("audio_codec") or _DEFAULT_AUDIO_CODEC
 
     if not url:
         return jsonify({"error": "URL is required"}), 400
+    if audio_codec not in _AUDIO_CODECS:
+        return jsonify({"error": f"audio_codec must be one of {', '.join(_AUDIO_CODECS)}"}), 400
+
+    from app.downloader import video_key
 
-    key = _new_key()
+    sig = (video_key(url), format_id, audio_only, audio_codec)
+    new_key = _new_key()
+    key = _claim_inflight(sig, new_key)
 
-    socketio.emit("download_started", {"key": key, "status": "queued"})
+    subscriber = _add_subscriber(key)
+
+    if key != new_key:
+        # same video/format already queued or running: share its events
+        # no emit: this client has not joined the room yet, the HTTP reply
+        # carries the status and on_join replays the rest
+        status = (_get_download(key) or {}).get("status", "queued")
+        return jsonify({"key": key, "status": status, "subscriber": subscriber})
+
+    _set_download(key, {"status": "queued", "sig": sig})
+
+    def emit_error(e):
+        # full traceback only when debugging; the message is always logged
+        logger.error("Download %s failed: %s", key, e,
+                     exc_info=logger.isEnabledFor(logging.DEBUG))
+        _set_download(key, {"status": "error", "message": str(e)})
+        socketio.emit("download_complete", {
+            "key": key,
+            "status": "error",
+            "message": str(e)
+        }, to=key)
+
+    def bg_process(result):
+        try:
+            process_file(
+                result["filepath"], "aac", audio_only, key, result.get("title"),
+                audio_codec=audio_codec,
+                acodec=result.get("acodec"),
+                vcodec=result.get("vcodec"),
+                duration=result.get("duration"),
+            )
+        except Exception as e:
+            emit_error(e)
 
     def bg_download():
         try:
             from app.downloader import download_video
 
+            _set_download(key, {"status": "downloading"})
             socketio.emit("download_status", {
                 "key": key,
                 "status": "downloading",
                 "message": "Downloading..."
-            })
+            }, to=key)
 
-            eventlet.sleep(0.1)
+            eventlet.sleep(0)
             result = download_video(
                 url,
                 format_id=format_id,
                 audio_only=audio_only,
                 key=key,
-                socket=socketio
+                socket=socketio,
+                audio_codec=audio_codec,
             )
 
+            _set_download(key, {
+                "status": "processing",
+                "title": result.get("title"),
+                "job_dir": result["job_dir"],
+            })
             socketio.emit("download_status", {
                 "key": key,
                 "status": "processing",
                 "message": "Processing...",
                 "title": result.get("title")
-            })
+            }, to=key)
 
-            eventlet.sleep(0.1)
-            socketio.start_background_task(process_file, result["filepath"], "aac", audio_only, key, result.get("title"))        
+            eventlet.sleep(0)
+            _set_download(key, {"pp_future": _PP_POOL.submit(bg_process, result)})
 
         except Exception as e:
-            logger.error(traceback.format_exc())
-            socketio.emit("download_complete", {
-                "key": key,
-                "status": "error",
-                "message": str(e)
-            })
+            emit_error(e)
 
-    socketio.start_background_task(bg_download)
+    # status was set to queued above; the job may already have moved on
+    _set_download(key, {"future": _DL_POOL.submit(bg_download)})
 
-    return jsonify({"key": key, "status": "queued"})
+    return jsonify({"key": key, "status": "queued", "subscriber": subscriber})
 
 
-@app.route("/download/aac/<path:filename>")
-def download_aac(filename):
-    DST_DIR = "/app/download/aac"
-    path = os.path.join(DST_DIR, filename)
+_FUTURE_KEYS = ("future", "pp_future")
+# server-side bookkeeping, not returned by /status
+_PRIVATE_KEYS = _FUTURE_KEYS + ("job_dir", "completed_at", "sig", "subscribers")
 
-    if not os.path.exists(path):
-        return "File not found", 404
 
-    ascii_filename = ''.join(c if ord(c) < 128 else '_' for c in filename)
-    safe_filename = quote(filename)
-    file_size = os.path.getsize(path)
+@app.route("/status/<key>")
+def status(key):
+    job = _get_download(key)
+    if job is None:
+        return jsonify({"error": "Unknown key"}), 404
+
+    futures = [job[k] for k in _FUTURE_KEYS if k in job]
+    data = {k: v for k, v in job.items() if k not in _PRIVATE_KEYS}
+    data["running"] = any(not f.done() for f in futures)
+    return jsonify({"key": key, **data})
+
+
+@app.route("/cancel/<key>", methods=["POST"])
+def cancel(key):
+    job = _get_download(key)
+    if job is None:
+        return jsonify({"error": "Unknown key"}), 404
+
+    data = request.get_json(silent=True) or request.form
+    remaining = _drop_subscriber(key, data.get("subscriber"))
+    if remaining is None:
+        return jsonify({"error": "Not subscribed to this download"}), 403
+    if remaining:
+        # other clients joined this job: only this one detaches
+        return jsonify({"key": key, "cancelled": False, "subscribers": remaining})
+
+    # only jobs still waiting in a pool can be cancelled
+    cancelled = any(job[k].cancel() for k in _FUTURE_KEYS if k in job)
+    if cancelled:
+        _set_download(key, {"status": "cancelled"})
+    return jsonify({"key": key, "cancelled": cancelled})
+
+
+# Internal nginx location aliased to /app/download/aac, e.g.
+#   location /_internal/aac/ { internal; alias /app/download/aac/; }
+# When set, nginx sends the file (sendfile) instead of this process.
+_X_ACCEL_PREFIX = os.environ.get("X_ACCEL_PREFIX", "")
+
+# str.encode error handler: each run of non-ASCII chars -> one "_" per char
+codecs.register_error("underscore", lambda e: ("_" * (e.end - e.start), e.end))
+
 
-    headers = {
-        "Content-Disposition": f"attachment; filename='{ascii_filename}'; filename*=UTF-8''{safe_filename}",
-        "Content-Length": str(file_size),
-        "Content-Type": "application/octet-stream"
-    }
+# resolved once; symlinks included so a link can't point outside it
+_AAC_DIR = os.path.realpath("/app/download/aac")
 
-    def generate():
-        with open(path, "rb") as f:
-            while True:
-                chunk = f.read(8192)
-                if not chunk:
-                    break
-                yield chunk
 
-    return Response(generate(), headers=headers)
+@app.route("/download/aac/<path:filename>")
+def download_aac(filename):
+    DST_DIR = _AAC_DIR
+    path = os.path.realpath(os.path.join(DST_DIR, filename))
+
+    try:
+        is_file = stat.S_ISREG(os.stat(path).st_mode)
+    except OSError:
+        is_file = False
+
+    if not is_file or os.path.commonpath([DST_DIR, path]) != DST_DIR:
+        return "File not found", 404
+
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    download_name = _download_name(os.path.basename(path))
+
+    if _X_ACCEL_PREFIX:
+        ascii_filename = download_name.encode("ascii", "underscore").decode("ascii")
+        # quoted-string (RFC 6266): escape \ and " inside the quotes
+        ascii_filename = ascii_filename.replace("\\", "\\\\").replace('"', '\\"')
+        # redirect to the path validated above, not the raw URL segment
+        safe_filename = quote(os.path.relpath(path, DST_DIR).replace(os.sep, "/"))
+        headers = {
+            "Content-Disposition": f'attachment; filename="{ascii_filename}"; filename*=UTF-8\'\'{quote(download_name)}',
+            "Content-Type": mimetype,
+            "X-Accel-Redirect": _X_ACCEL_PREFIX.rstrip("/") + "/" + safe_filename,
+        }
+        return Response("", headers=headers)
+
+    # conditional: ETag / Last-Modified (304) and Range (206, Accept-Ranges)
+    # path is already resolved and confined to DST_DIR
+    return send_file(
+        path,
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=download_name,
+        conditional=True,
+        etag=True,
+        max_age=3600,
+    )
+
+
+# ---------- Socket.IO events ----------
+@socketio.on("join")
+def on_join(data):
+    """
+    Subscribe this client to one download's events (room = key).
+    Replays the current state, since events sent before the join are lost.
+    """
+    key = (data or {}).get("key")
+    if not key:
+        return
+
+    join_room(key)
+
+    job = _get_download(key)
+    if job is None:
+        return
+
+    # _add_subscriber creates the entry just before /download sets "queued"
+    status = job.get("status") or "queued"
+    if status == "done":
+        emit("download_complete", {
+            "key": key,
+            "status": "done",
+            "title": job.get("title"),
+            "download_url": job.get("download_url"),
+            "download_name": job.get("download_name"),
+        })
+    elif status in _TERMINAL_STATUSES:
+        emit("download_complete", {
+            "key": key,
+            "status": status,
+            "message": job.get("message", status),
+        })
+    else:
+        emit("download_status", {
+            "key": key,
+            "status": status,
+            "message": f"{status.capitalize()}...",
+            "title": job.get("title"),
+        })
 
 
 # ---------- Health check ----------
@@ -211,10 +827,8 @@ if __name__ == "__main__":
     if env == "local":
         # Local development only
         logger.info("LOCAL dev server on port %s", port)
-        import eventlet
-        eventlet.monkey_patch()
         socketio.run(app, host="0.0.0.0", port=port)
     else:
-        # Production-like (no monkey patch, gunicorn will be used)
+        # Production-like (gunicorn will be used)
         logger.info("PROD server (fallback) on port %s", port)
         socketio.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,141 @@
+import io
+
+import pytest
+
+pytest.importorskip("yt_dlp")
+
+import yt_dlp
+from yt_dlp.cookies import YoutubeDLCookieJar
+
+from app import downloader
+from app.downloader import _attach_cookie_jar, _canonical_url, _video_key
+
+
+def test_playlist_watch_urls_keep_their_video():
+    a = "https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PLFgquLnL59alCl_2TQvOiD5Vgm1hCaGSI&index=1"
+    b = "https://www.youtube.com/watch?v=9bZkp7q19f0&list=PLFgquLnL59alCl_2TQvOiD5Vgm1hCaGSI&index=2"
+
+    assert _video_key(a) == ("Youtube", "dQw4w9WgXcQ")
+    assert _video_key(b) == ("Youtube", "9bZkp7q19f0")
+    assert _video_key(a) != _video_key(b)
+
+
+def test_playlist_url_without_video_keeps_list():
+    url = "https://www.youtube.com/playlist?list=PLFgquLnL59alCl_2TQvOiD5Vgm1hCaGSI"
+    assert "list=" in _canonical_url(url)
+
+
+def _handler_jars(ydl):
+    return [h.cookiejar for h in ydl._request_director.handlers.values()]
+
+
+def test_cookie_jar_reaches_prebuilt_request_director():
+    # impersonate makes YoutubeDL.__init__ build the director early
+    jar = YoutubeDLCookieJar()
+    with yt_dlp.YoutubeDL({"quiet": True}) as ydl:
+        ydl._request_director
+        _attach_cookie_jar(ydl, jar)
+
+        jars = _handler_jars(ydl)
+        assert jars
+        assert all(j is jar for j in jars)
+
+
+def test_pooled_ydl_handlers_share_cookie_jar(monkeypatch):
+    jar = YoutubeDLCookieJar()
+    monkeypatch.setattr(downloader, "_cookie_jar", jar)
+    monkeypatch.setattr(downloader, "_YDL_CACHE", {})
+
+    with downloader._get_ydl({"quiet": True}) as ydl:
+        assert ydl.cookiejar is jar
+        assert all(j is jar for j in _handler_jars(ydl))
+
+
+def _fmt(format_id, **kw):
+    return {"format_id": format_id, **kw}
+
+
+def test_pick_best_mp4_prefers_avc1_video_only_and_original_audio():
+    formats = [
+        _fmt("18", ext="mp4", vcodec="avc1.42001E", acodec="mp4a.40.2", height=360),
+        _fmt("399", ext="mp4", vcodec="av01.0.08M.08", acodec="none", height=1080),
+        _fmt("137", ext="mp4", vcodec="avc1.640028", acodec="none", height=1080, fps=30),
+        _fmt("136", ext="mp4", vcodec="avc1.4d401f", acodec="none", height=720),
+        _fmt("hdr", ext="mp4", vcodec="avc1.640033", acodec="none", height=2160, dynamic_range="HDR10"),
+        _fmt("140-dub", ext="m4a", vcodec="none", acodec="mp4a.40.2", tbr=130, language_preference=-1),
+        _fmt("140-orig", ext="m4a", vcodec="none", acodec="mp4a.40.2", tbr=128,
+             language_preference=10, format_note="English original (default)"),
+        _fmt("251", ext="webm", vcodec="none", acodec="opus", tbr=160),
+    ]
+    assert downloader._pick_best_mp4(formats) == "137+140-orig"
+
+
+def test_pick_best_mp4_needs_both_streams():
+    only_muxed = [_fmt("18", ext="mp4", vcodec="avc1.42001E", acodec="mp4a.40.2", height=360)]
+    assert downloader._pick_best_mp4(only_muxed) is None
+    assert downloader._pick_best_mp4([]) is None
+
+
+def _http_error(status):
+    from yt_dlp.networking import Response
+    from yt_dlp.networking.exceptions import HTTPError
+
+    return HTTPError(Response(io.BytesIO(b""), "https://example.com", {}, status=status))
+
+
+def _wrapped(err):
+    # the shape yt-dlp raises: DownloadError -> ExtractorError -> HTTPError
+    from yt_dlp.utils import DownloadError, ExtractorError
+
+    inner = ExtractorError("extract failed", cause=err)
+    return DownloadError("download failed", exc_info=(type(inner), inner, None))
+
+
+@pytest.mark.parametrize("status, transient", [
+    (429, True), (503, True), (403, True), (404, False), (410, False),
+])
+def test_is_transient_reads_wrapped_http_status(status, transient):
+    assert downloader._is_transient(_wrapped(_http_error(status))) is transient
+
+
+def test_is_transient_network_errors():
+    from yt_dlp.networking.exceptions import TransportError
+    from yt_dlp.utils import DownloadError
+
+    assert downloader._is_transient(_wrapped(TransportError("reset")))
+    assert not downloader._is_transient(DownloadError("Requested format is not available"))
+
+
+def test_backoff_delay_grows_and_is_capped(monkeypatch):
+    # jitter factor 0.5 + 0.5 = 1.0
+    monkeypatch.setattr(downloader.random, "random", lambda: 0.5)
+    plain = _wrapped(_http_error(503))
+
+    assert downloader._backoff_delay(0, plain) == downloader._BACKOFF_BASE
+    assert downloader._backoff_delay(1, plain) == downloader._BACKOFF_BASE * 2
+    assert downloader._backoff_delay(20, plain) == downloader._BACKOFF_MAX
+    assert downloader._backoff_delay(0, _wrapped(_http_error(429))) == 5.0
+
+
+def test_attempt_opts_restores_pooled_ydl_state():
+    fopt = {
+        "format": "worst",
+        "paths": {"home": "/tmp/job-x"},
+        "postprocessors": [{"key": "FFmpegExtractAudio", "preferredcodec": "m4a"}],
+    }
+    with yt_dlp.YoutubeDL({"quiet": True, "format": "best"}) as ydl:
+        params = dict(ydl.params)
+        selector = ydl.format_selector
+        pps = {when: list(p) for when, p in ydl._pps.items()}
+
+        with pytest.raises(RuntimeError):
+            with downloader._attempt_opts(ydl, fopt):
+                assert ydl.params["format"] == "worst"
+                assert ydl.params["paths"] == {"home": "/tmp/job-x"}
+                assert ydl.format_selector is not selector
+                assert len(ydl._pps["post_process"]) == len(pps["post_process"]) + 1
+                raise RuntimeError("attempt failed")
+
+        assert ydl.params == params
+        assert ydl.format_selector is selector
+        assert {when: list(p) for when, p in ydl._pps.items()} == pps
@@ -0,0 +1,163 @@
+import os
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("flask_socketio")
+pytest.importorskip("eventlet")
+
+from app import main
+
+
+@pytest.fixture
+def jobs(monkeypatch):
+    # fresh job state per test
+    monkeypatch.setattr(main, "_downloads", [({}, main.threading.Lock()) for _ in range(main._DOWNLOAD_SHARDS)])
+    monkeypatch.setattr(main, "_inflight", {})
+
+
+@pytest.fixture
+def client():
+    main.app.config["TESTING"] = True
+    return main.app.test_client()
+
+
+class _Future:
+    def __init__(self, cancellable=True):
+        self.cancellable = cancellable
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = self.cancellable
+        return self.cancellable
+
+
+# ---------- inflight dedup / subscribers ----------
+def test_claim_inflight_dedups_until_terminal(jobs):
+    sig = (("Youtube", "abc"), None, False, "copy")
+
+    assert main._claim_inflight(sig, "k1") == "k1"
+    assert main._claim_inflight(sig, "k2") == "k1"
+
+    main._set_download("k1", {"status": "queued", "sig": sig})
+    # a non-terminal update keeps the claim
+    assert main._claim_inflight(sig, "k3") == "k1"
+
+    main._set_download("k1", {"status": "done"})
+    assert main._claim_inflight(sig, "k4") == "k4"
+
+
+def test_terminal_update_of_an_old_job_keeps_the_new_claim(jobs):
+    sig = (("Youtube", "abc"), None, False, "copy")
+    main._set_download("old", {"status": "downloading", "sig": sig})
+    main._inflight[sig] = "new"
+
+    main._set_download("old", {"status": "error"})
+    assert main._inflight[sig] == "new"
+
+
+def test_subscriber_refcount(jobs):
+    a = main._add_subscriber("k")
+    b = main._add_subscriber("k")
+    assert a != b
+
+    assert main._drop_subscriber("k", "nope") is None
+    assert main._drop_subscriber("k", a) == 1
+    assert main._drop_subscriber("k", a) is None
+    assert main._drop_subscriber("k", b) == 0
+    assert main._drop_subscriber("missing", b) is None
+
+
+def test_cancel_waits_for_the_last_subscriber(jobs, client):
+    a = main._add_subscriber("k")
+    b = main._add_subscriber("k")
+    future = _Future()
+    main._set_download("k", {"status": "queued", "future": future})
+
+    res = client.post("/cancel/k", json={"subscriber": a})
+    assert res.status_code == 200
+    assert res.get_json() == {"key": "k", "cancelled": False, "subscribers": 1}
+    assert not future.cancelled
+
+    res = client.post("/cancel/k", json={"subscriber": b})
+    assert res.get_json() == {"key": "k", "cancelled": True}
+    assert future.cancelled
+    assert main._get_download("k")["status"] == "cancelled"
+
+
+def test_cancel_rejects_unknown_key_and_token(jobs, client):
+    main._add_subscriber("k")
+    main._set_download("k", {"status": "queued", "future": _Future()})
+
+    assert client.post("/cancel/unknown", json={"subscriber": "x"}).status_code == 404
+    assert client.post("/cancel/k", json={"subscriber": "x"}).status_code == 403
+    assert client.post("/cancel/k", json={}).status_code == 403
+
+
+def test_cancel_running_job_is_not_cancelled(jobs, client):
+    a = main._add_subscriber("k")
+    main._set_download("k", {"status": "downloading", "future": _Future(cancellable=False)})
+
+    res = client.post("/cancel/k", json={"subscriber": a})
+    assert res.get_json() == {"key": "k", "cancelled": False}
+    assert main._get_download("k")["status"] == "downloading"
+
+
+# ---------- passthrough ----------
+@pytest.mark.parametrize("ext, audio_only, acodec, vcodec, expected", [
+    (".m4a", True, "mp4a.40.2", "none", "/d/x.m4a"),
+    (".mp4", True, "mp4a.40.2", "none", "/d/x.m4a"),
+    (".mp4", False, "mp4a.40.2", "avc1.640028", "/d/x.mp4"),
+    (".mp4", False, "aac", "avc1.4d401f", "/d/x.mp4"),
+    (".mp4", True, "mp4a.40.2", "avc1.640028", None),
+    (".mp4", False, "opus", "avc1.640028", None),
+    (".mp4", False, "mp4a.40.2", "vp09.00.40.08", None),
+    (".webm", True, "opus", "none", None),
+    (".m4a", True, None, None, None),
+])
+def test_passthrough_dst(ext, audio_only, acodec, vcodec, expected):
+    assert main._passthrough_dst("/d/x", ext, audio_only, acodec, vcodec) == expected
+
+
+def test_download_name_strips_job_suffix():
+    assert main._download_name("Song.140-1a2b3c4d.m4a") == "Song.140.m4a"
+    assert main._download_name("Song.m4a") == "Song.m4a"
+
+
+# ---------- /download/aac ----------
+@pytest.fixture
+def aac_dir(tmp_path, monkeypatch):
+    served = tmp_path / "aac"
+    served.mkdir()
+    (served / "Song-1a2b3c4d.m4a").write_bytes(b"m4a")
+    (tmp_path / "secret.txt").write_text("secret")
+    os.symlink(tmp_path / "secret.txt", served / "link.m4a")
+    monkeypatch.setattr(main, "_AAC_DIR", os.path.realpath(served))
+    monkeypatch.setattr(main, "_X_ACCEL_PREFIX", "")
+    return served
+
+
+def test_download_aac_serves_file_with_clean_name(aac_dir, client):
+    res = client.get("/download/aac/Song-1a2b3c4d.m4a")
+    assert res.status_code == 200
+    assert res.data == b"m4a"
+    assert 'filename=Song.m4a' in res.headers["Content-Disposition"]
+
+
+@pytest.mark.parametrize("name", [
+    "../secret.txt",
+    "%2e%2e/secret.txt",
+    "link.m4a",
+    "missing.m4a",
+])
+def test_download_aac_rejects_paths_outside_the_dir(aac_dir, client, name):
+    assert client.get(f"/download/aac/{name}").status_code == 404
+
+
+def test_download_aac_x_accel_uses_validated_path(aac_dir, client, monkeypatch):
+    monkeypatch.setattr(main, "_X_ACCEL_PREFIX", "/_internal/aac/")
+
+    res = client.get("/download/aac/Song-1a2b3c4d.m4a")
+    assert res.status_code == 200
+    assert res.headers["X-Accel-Redirect"] == "/_internal/aac/Song-1a2b3c4d.m4a"
+    assert res.headers["Content-Disposition"].startswith('attachment; filename="Song.m4a"')